@@ -0,0 +1,509 @@
+import asyncio
+import collections
+import heapq
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functions import *
+
+# Programmatic API of the exitsigner
+# Example:
+# config = Config.from_env()
+# detect_stereum_config(config)
+# config.validate()
+# reconciliation = reconcile(config)
+# with prepare(config) as preparation:
+#     for result in sign(config, reconciliation.pending, mnemonic, preparation):
+#         print(result.status, result.validator.key)
+
+#
+# CONFIG
+#
+
+# Default config values
+default_values = {
+    "KAPI_URL": "http://127.0.0.1:3600",
+    "NODE_URL": "http://127.0.0.1:5052",
+    "OPERATOR_ID": "",
+    "SIGN_PERCENT": 10,
+    "VALIDATOR_EJECTOR_MESSAGE_FOLDER": "",
+    "ETHDO_VERSION": "1.39.0",
+}
+
+# Get ethdo download URL for given version and the current OS
+def get_ethdo_url(ethdo_version):
+    system_platform = platform.system()
+    if system_platform == "Darwin":
+        return f"https://github.com/wealdtech/ethdo/releases/download/v{ethdo_version}/ethdo-{ethdo_version}-darwin-amd64.tar.gz"
+    elif system_platform == "Windows":
+        return f"https://github.com/wealdtech/ethdo/releases/download/v{ethdo_version}/ethdo-{ethdo_version}-windows-exe.zip"
+    else:
+        return f"https://github.com/wealdtech/ethdo/releases/download/v{ethdo_version}/ethdo-{ethdo_version}-linux-amd64.tar.gz"
+
+# Config of an exitsigner run
+# home_dir is where ethdo gets installed and signing-stats.json plus the work dirs of runs (with offline-preparation.json) are stored
+class Config:
+    def __init__(self, kapi_url=default_values["KAPI_URL"], node_url=default_values["NODE_URL"], operator_id=default_values["OPERATOR_ID"],
+                 sign_percent=default_values["SIGN_PERCENT"], message_folder=default_values["VALIDATOR_EJECTOR_MESSAGE_FOLDER"],
+                 ethdo_version=default_values["ETHDO_VERSION"], home_dir=None, messages_password=None):
+        self.kapi_url = kapi_url
+        self.node_url = node_url
+        self.operator_id = operator_id
+        self.sign_percent = sign_percent
+        self.message_folder = message_folder
+        self.ethdo_version = str(ethdo_version).lower().replace("v","")
+        self.home_dir = home_dir if home_dir else script_home_dir()
+        self.messages_password = messages_password
+
+    # Retrieve config values from environment (or given dict) or use defaults
+    @classmethod
+    def from_env(cls, env=None, **kwargs):
+        env = os.environ if env is None else env
+        return cls(
+            kapi_url=env.get("KAPI_URL", default_values["KAPI_URL"]),
+            node_url=env.get("NODE_URL", default_values["NODE_URL"]),
+            operator_id=env.get("OPERATOR_ID", default_values["OPERATOR_ID"]),
+            sign_percent=int(env.get("SIGN_PERCENT", default_values["SIGN_PERCENT"])),
+            message_folder=env.get("VALIDATOR_EJECTOR_MESSAGE_FOLDER", default_values["VALIDATOR_EJECTOR_MESSAGE_FOLDER"]),
+            ethdo_version=env.get("ETHDO_VERSION", default_values["ETHDO_VERSION"]),
+            **kwargs,
+        )
+
+    @property
+    def ethdo_url(self):
+        return get_ethdo_url(self.ethdo_version)
+
+    @property
+    def claims_folder(self):
+        return get_claims_folder(self.message_folder)
+
+    @property
+    def signing_stats_file(self):
+        return os.path.join(self.home_dir, 'signing-stats.json')
+
+    # Check config values and raise ValueError with a description of the first invalid setting
+    def validate(self):
+        if not is_valid_url(self.node_url):
+            raise ValueError("Setting NODE_URL invalid or not specified (Expected valid URL)")
+        if not is_valid_url(self.kapi_url):
+            raise ValueError("Setting KAPI_URL invalid or not specified (Expected valid URL)")
+        if not self.operator_id or not is_whole_number(self.operator_id):
+            raise ValueError("Setting OPERATOR_ID invalid or not specified")
+        if not is_whole_number(self.sign_percent) or self.sign_percent > 100 or self.sign_percent < 1:
+            raise ValueError("Setting SIGN_PERCENT invalid or not specified (Expected range 1-100)")
+        if not self.message_folder:
+            raise ValueError("Could not find path to validatorejector messages folder (VALIDATOR_EJECTOR_MESSAGE_FOLDER)")
+        if "validatorejector" not in self.message_folder:
+            raise ValueError("Path for setting VALIDATOR_EJECTOR_MESSAGE_FOLDER must contain 'validatorejector'")
+        if not self.message_folder.endswith("messages"):
+            raise ValueError("Path for setting VALIDATOR_EJECTOR_MESSAGE_FOLDER must end with 'messages'")
+        if not os.path.exists(self.message_folder):
+            raise ValueError("Path for setting VALIDATOR_EJECTOR_MESSAGE_FOLDER does not exist")
+        if not is_semantic_version(self.ethdo_version):
+            raise ValueError("Setting ETHDO_VERSION invalid or not specified (Expected valid semantic version)")
+        if not is_valid_url(self.ethdo_url):
+            raise ValueError("Setting ETHDO_URL invalid or not specified (Expected valid URL)")
+
+# Auto detect validatorejector message folder, NODE_URL, OPERATOR_ID and MESSAGES_PASSWORD (for Stereum users)
+# Only settings that still have their default value are overwritten
+# Returns dict with the detection details
+def detect_stereum_config(config, expected_home_directory="/opt/stereum", services_directory="/etc/stereum/services"):
+    detected = {"validator_ejector_folder": detect_validatorejector_directory(expected_home_directory)}
+    validator_ejector_folder = detected["validator_ejector_folder"]
+    if config.message_folder == default_values["VALIDATOR_EJECTOR_MESSAGE_FOLDER"]:
+        config.message_folder = os.path.join(validator_ejector_folder, "messages") if validator_ejector_folder is not None else None
+    if validator_ejector_folder:
+        validator_ejector_config_id = os.path.basename(validator_ejector_folder.replace("validatorejector-", ""))
+        validator_ejector_yaml_file = os.path.join(services_directory, f"{validator_ejector_config_id}.yaml")
+        detected["validator_ejector_config_id"] = validator_ejector_config_id
+        detected["validator_ejector_yaml_file"] = validator_ejector_yaml_file
+        if os.path.exists(validator_ejector_yaml_file):
+            validator_ejector_yaml_data = read_yaml_file(validator_ejector_yaml_file)
+            detected["validator_ejector_yaml_data"] = validator_ejector_yaml_data
+            config.node_url = validator_ejector_yaml_data['env']['CONSENSUS_NODE'] if config.node_url == default_values["NODE_URL"] else config.node_url
+            config.operator_id = validator_ejector_yaml_data['env']['OPERATOR_ID'] if config.operator_id == default_values["OPERATOR_ID"] else config.operator_id
+            if not config.messages_password:
+                config.messages_password = validator_ejector_yaml_data['env'].get('MESSAGES_PASSWORD')
+    return detected
+
+#
+# RECONCILE
+#
+
+# Result of reconciling the validators from KAPI against the existing messages
+class Reconciliation:
+    def __init__(self, validators, existing, active, pending):
+        self.validators = validators    # Number of validators that need a signed exit message
+        self.existing = existing        # Set of validator keys with an existing message
+        self.active = active            # Set of validator keys with an existing message that is still needed
+        self.pending = pending          # List of ValidatorRecord that have no signed exit message yet
+
+    @property
+    def burned(self):
+        return len(self.existing) - len(self.active)
+
+    # Machine readable plan incl. estimated signing cost (based on earlier runs if available)
+    def plan(self, config):
+        return {
+            "operator_id": int(float(config.operator_id)),
+            "sign_percent": config.sign_percent,
+            "message_folder": config.message_folder,
+            "validators": self.validators,
+            "existing": len(self.existing),
+            "active": len(self.active),
+            "burned": self.burned,
+            "pending": len(self.pending),
+            "pending_validators": [{"key": validator.key, "validatorIndex": validator.validatorIndex} for validator in self.pending],
+            "estimate": estimate_signing_cost(len(self.pending), read_signing_stats(config.signing_stats_file)),
+        }
+
+# Get existing messages and reconcile them with the validators that need a signed exit message from KAPI
+# The KAPI response is streamed, each validator is reconciled as it arrives
+# Raises RuntimeError with the reason if KAPI could not be read
+def reconcile(config):
+    existing = set()
+    for filepath in get_json_files(config.message_folder):
+        existing.add(os.path.splitext(os.path.basename(filepath))[0])
+    validators = get_validators_that_need_a_signed_exit_message_from_kapi(config.operator_id, config.kapi_url, config.sign_percent)
+    count = 0
+    active = set()
+    pending = []
+    for validator in validators:
+        count += 1
+        if validator.key in existing:
+            active.add(validator.key)
+        else:
+            pending.append(validator)
+    return Reconciliation(count, existing, active, pending)
+
+#
+# PREPARE
+#
+
+# Prepared ethdo environment for offline signing
+# Each preparation has its own work dir with offline-preparation.json, so concurrent runs never share it
+# Use as context manager (or call close) to remove the work dir and stop key derivation afterwards
+class Preparation:
+    def __init__(self, config, ethdo_path, work_dir, keystore_pool=None, keystore_key_future=None):
+        self.config = config
+        self.ethdo_path = ethdo_path
+        self.work_dir = work_dir
+        self.keystore_pool = keystore_pool
+        self.keystore_key_future = keystore_key_future
+
+    @property
+    def encrypt(self):
+        return self.keystore_key_future is not None
+
+    @property
+    def offline_preparation_json(self):
+        return os.path.join(self.work_dir, 'offline-preparation.json')
+
+    # Get tuple of (kdf params, derived key) to encrypt messages (waits for the key derivation to finish)
+    def keystore_key(self):
+        return self.keystore_key_future.result() if self.keystore_key_future else None
+
+    def close(self):
+        if self.keystore_pool:
+            self.keystore_pool.shutdown(cancel_futures=True)
+            self.keystore_pool = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Install ethdo and generate offline-preparation.json (this will generate all infos needed for signing)
+# If encrypt is True, the key for encrypted messages is derived from config.messages_password in a separate process meanwhile
+# Transient ethdo errors (e.g. beacon node not reachable) are retried with exponential backoff (up to max_attempts)
+def prepare(config, encrypt=False, max_attempts=5, retry_delay=5, max_retry_delay=300):
+    keystore_pool, keystore_key_future = None, None
+    if encrypt:
+        if not config.messages_password:
+            raise ValueError("Setting MESSAGES_PASSWORD not specified (Required to encrypt messages)")
+        keystore_pool = ProcessPoolExecutor(max_workers=1)
+        keystore_key_future = keystore_pool.submit(derive_keystore_key, config.messages_password)
+    work_dir = None
+    try:
+        # Concurrent runs share the ethdo installation, so only one of them may install it at a time
+        with hold_lock(os.path.join(config.home_dir, "ethdo.lock"), timeout=600):
+            ethdo_path = install_ethdo(config.ethdo_url, install_dir=config.home_dir)
+        if not ethdo_path:
+            raise RuntimeError("Failed to install ethdo")
+        ethdo_path = os.path.abspath(ethdo_path)
+        work_dir = tempfile.mkdtemp(prefix="exitsigner-", dir=config.home_dir)
+        attempt = 1
+        while True:
+            process = subprocess.run(f"{ethdo_path} --connection={config.node_url} validator exit --json --verbose --debug --prepare-offline", capture_output=True, text=True, shell=True, cwd=work_dir)
+            if process.returncode == 0:
+                break
+            if attempt >= max_attempts or classify_ethdo_error(get_last_line(process.stderr.strip())) != "transient":
+                raise RuntimeError(f"Could not generate offline-preparation.json due to ethdo error ({process.stderr.strip()})")
+            time.sleep(get_retry_delay(attempt, retry_delay, max_retry_delay))
+            attempt += 1
+    except BaseException:
+        if keystore_pool:
+            keystore_pool.shutdown(cancel_futures=True)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    return Preparation(config, ethdo_path, work_dir, keystore_pool, keystore_key_future)
+
+#
+# SIGN
+#
+
+# Result of signing the exit message for one validator
+class SignResult:
+    __slots__ = ("validator", "status", "error", "error_kind", "attempt", "path", "seconds", "retry_in")
+
+    SIGNED = "signed"
+    FAILED = "failed"
+    RETRY = "retry"         # Transient error, validator was queued to be retried after retry_in seconds
+    SKIPPED = "skipped"     # Claimed or already signed by another exitsigner run
+
+    def __init__(self, validator, status, error=None, error_kind=None, attempt=1, path=None, seconds=0.0, retry_in=None):
+        self.validator = validator
+        self.status = status
+        self.error = error
+        self.error_kind = error_kind    # "fatal", "permanent" or "transient" (see classify_ethdo_error)
+        self.attempt = attempt
+        self.path = path
+        self.seconds = seconds
+        self.retry_in = retry_in
+
+# Sign exit messages for given validators and yield a SignResult for each attempt as soon as it is done
+# Failures are classified by the last line of the ethdo error:
+# - fatal errors (e.g. invalid mnemonic) abort signing
+# - permanent errors (e.g. key not found within max distance) only skip the affected validator
+# - transient errors queue the validator for a retry with exponential backoff (up to max_attempts)
+#   (this includes a timeout on the claims folder lock held by a concurrent exitsigner run)
+# Retries are interleaved with the remaining validators so the run keeps going in the meantime
+# Exit messages stay valid across forks, since Deneb (EIP-7044) voluntary exits are always signed with the Capella fork version
+def sign(config, validators, mnemonic, preparation, max_attempts=5, retry_delay=5, max_retry_delay=300):
+    message_folder = config.message_folder
+    claims_folder = get_claims_folder(message_folder)
+    create_directory(claims_folder)
+    signed = 0
+    # Time and CPU of successful ethdo calls only, so retry delays and lock waits do not skew the plan estimates
+    signing_seconds = 0.0
+    signing_cpu_seconds = 0.0
+    validators = iter(validators)
+    retry_queue = []    # heap of (not before, sequence, attempt, validator)
+    retry_sequence = 0
+    try:
+        while True:
+            # Take due retries first, otherwise the next validator (or wait for the next retry)
+            if retry_queue and retry_queue[0][0] <= time.monotonic():
+                _, _, attempt, validator = heapq.heappop(retry_queue)
+            else:
+                validator = next(validators, None)
+                if validator is None:
+                    if not retry_queue:
+                        break
+                    time.sleep(max(0, retry_queue[0][0] - time.monotonic()))
+                    continue
+                attempt = 1
+            validator_started = time.monotonic()
+            try:
+                claimed = claim_validator(claims_folder, message_folder, validator.key)
+            except LockTimeoutError as e:
+                # Claims folder is busy, retry this validator later instead of ending the run
+                claimed = None
+                error = str(e)
+                error_kind = "transient"
+            # Skip validators that another exitsigner run already signed or is currently signing
+            if claimed is False:
+                yield SignResult(validator, SignResult.SKIPPED, attempt=attempt)
+                continue
+            if claimed:
+                write_error = None
+                try:
+                    save_path = os.path.join(message_folder, f"{validator.key}.json")
+                    ethdo_started = time.monotonic()
+                    ethdo_started_cpu = get_children_cpu_seconds()
+                    process = subprocess.run(f"{preparation.ethdo_path} --connection={config.node_url} validator exit --json --verbose --debug --offline --max-distance=20480 --validator='{validator.key}' --mnemonic='{mnemonic}'", capture_output=True, text=True, shell=True, cwd=preparation.work_dir)
+                    ethdo_seconds = time.monotonic() - ethdo_started
+                    ethdo_cpu_seconds = get_children_cpu_seconds() - ethdo_started_cpu
+                    if process.returncode == 0:
+                        # Publish the (optionally encrypted) message atomically so the ejector never reads partial files
+                        message = process.stdout.strip()
+                        if preparation.encrypt:
+                            keystore_kdf_params, keystore_key = preparation.keystore_key()
+                            message = json.dumps(encrypt_keystore_message(message, keystore_kdf_params, keystore_key), indent=2)
+                        try:
+                            write_file_atomic(save_path, message)
+                        except OSError as e:
+                            write_error = f"Could not write exit message to '{save_path}' ({e})"
+                finally:
+                    release_validator_claim(claims_folder, validator.key)
+                if process.returncode != 0:
+                    error = get_last_line(process.stderr.strip())
+                    error_kind = classify_ethdo_error(error)
+                elif write_error:
+                    error = write_error
+                    error_kind = "permanent"
+                else:
+                    signed += 1
+                    signing_seconds += ethdo_seconds
+                    signing_cpu_seconds += ethdo_cpu_seconds
+                    yield SignResult(validator, SignResult.SIGNED, attempt=attempt, path=save_path, seconds=time.monotonic() - validator_started)
+                    continue
+            seconds = time.monotonic() - validator_started
+            if error_kind == "transient" and attempt < max_attempts:
+                retry_in = get_retry_delay(attempt, retry_delay, max_retry_delay)
+                heapq.heappush(retry_queue, (time.monotonic() + retry_in, retry_sequence, attempt + 1, validator))
+                retry_sequence += 1
+                yield SignResult(validator, SignResult.RETRY, error=error, error_kind=error_kind, attempt=attempt, seconds=seconds, retry_in=retry_in)
+                continue
+            yield SignResult(validator, SignResult.FAILED, error=error, error_kind=error_kind, attempt=attempt, seconds=seconds)
+            if error_kind == "fatal":
+                return
+    finally:
+        # Remember measured signing throughput for plan estimates
+        update_signing_stats(config.signing_stats_file, signed, signing_seconds, signing_cpu_seconds)
+
+# Async variant of sign, each validator is signed in the default executor of the running event loop
+async def sign_async(config, validators, mnemonic, preparation, **kwargs):
+    loop = asyncio.get_running_loop()
+    results = sign(config, validators, mnemonic, preparation, **kwargs)
+    done = object()
+    try:
+        while True:
+            result = await loop.run_in_executor(None, next, results, done)
+            if result is done:
+                return
+            yield result
+    finally:
+        results.close()
+
+#
+# PROGRESS
+#
+
+# Track signing progress with a moving average signing rate and ETA
+# Thread safe, so results of multiple workers can be added to the same instance
+class Progress:
+    def __init__(self, total, window=20):
+        self.total = total
+        self.signed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.completed_at = collections.deque([self.started], maxlen=window + 1)
+        self.lock = threading.Lock()
+
+    # Add SignResult to progress
+    def update(self, result):
+        with self.lock:
+            if result.status == SignResult.RETRY:
+                self.retries += 1
+                return
+            if result.status == SignResult.SIGNED:
+                self.signed += 1
+            elif result.status == SignResult.FAILED:
+                self.failed += 1
+            else:
+                self.skipped += 1
+                return
+            self.completed_at.append(time.monotonic())
+
+    @property
+    def pending(self):
+        return max(self.total - self.signed - self.failed - self.skipped, 0)
+
+    # Validators per second over the last window completions
+    @property
+    def rate(self):
+        with self.lock:
+            if len(self.completed_at) < 2 or self.completed_at[-1] <= self.completed_at[0]:
+                return None
+            return (len(self.completed_at) - 1) / (self.completed_at[-1] - self.completed_at[0])
+
+    # Estimated seconds until all pending validators are done (None if no rate known yet)
+    @property
+    def eta(self):
+        rate = self.rate
+        return self.pending / rate if rate else None
+
+    def snapshot(self):
+        rate = self.rate
+        return {
+            "total": self.total,
+            "signed": self.signed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "pending": self.pending,
+            "retries": self.retries,
+            "rate_per_minute": round(rate * 60, 2) if rate else None,
+            "eta_seconds": round(self.pending / rate) if rate else None,
+            "elapsed_seconds": round(time.monotonic() - self.started),
+        }
+
+# Write run events as human readable text or as JSON lines (log_format "jsonl") for log pipelines
+# Progress events are rate-limited to one per interval seconds so output never slows down signing
+class EventLog:
+    def __init__(self, log_format="text", interval=30, stream=None):
+        self.log_format = log_format
+        self.interval = interval
+        self.stream = stream if stream else sys.stdout
+        self.progress = None
+        self.last_progress = time.monotonic()
+
+    def write(self, text):
+        print(text, file=self.stream, flush=self.log_format == "jsonl")
+
+    # Write event with human readable message (text) or all fields (jsonl)
+    def event(self, event, message, **fields):
+        if self.log_format == "jsonl":
+            self.write(json.dumps({"time": round(time.time(), 3), "event": event, "message": message, **fields}))
+        else:
+            self.write(message)
+
+    # Start tracking progress for given number of validators
+    def start(self, total):
+        self.progress = Progress(total)
+        self.last_progress = time.monotonic()
+        return self.progress
+
+    # Write SignResult event and the current progress if the interval elapsed
+    def result(self, result, debug=False):
+        self.progress.update(result)
+        fields = {
+            "key": result.validator.key,
+            "validatorIndex": result.validator.validatorIndex,
+            "status": result.status,
+            "attempt": result.attempt,
+            "seconds": round(result.seconds, 3),
+        }
+        if result.error:
+            fields.update({"error": result.error, "error_kind": result.error_kind})
+        if result.status == SignResult.SIGNED:
+            self.event("signed", f"Generated exit message for validator {result.validator.key} ({result.validator.validatorIndex})", **fields)
+        elif result.status == SignResult.SKIPPED:
+            if debug or self.log_format == "jsonl":
+                self.event("skipped", f"[DEBUG] Skip validator {result.validator.key} (claimed or signed by another exitsigner run)", **fields)
+        elif result.status == SignResult.RETRY:
+            self.event("retry", f"Could not generate exit message for validator {result.validator.key} ({result.error}), retry in {result.retry_in} seconds", retry_in=result.retry_in, **fields)
+        else:
+            self.event("failed", f"Could not generate exit message for validator {result.validator.key} ({result.error})", **fields)
+        if time.monotonic() - self.last_progress >= self.interval:
+            self.report_progress()
+
+    # Write current progress
+    def report_progress(self):
+        self.last_progress = time.monotonic()
+        snapshot = self.progress.snapshot()
+        rate = f"{snapshot['rate_per_minute']} validators/min" if snapshot["rate_per_minute"] else "rate unknown"
+        eta = format_duration(snapshot["eta_seconds"]) if snapshot["eta_seconds"] is not None else "unknown"
+        self.event("progress", f"Progress: {snapshot['signed']} signed, {snapshot['failed']} failed, {snapshot['pending']} pending of {snapshot['total']} ({rate}, ETA {eta})", **snapshot)
@@ -1,15 +1,22 @@
+import contextlib
 import ctypes
 import getpass
 import glob
+import json
 import os
 import platform
 import re
 import subprocess
 import sys
 import tarfile
+import tempfile
+import time
+import unicodedata
+import uuid
 from urllib.parse import urlparse
 import zipfile
 import requests
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 import oyaml as yaml
 import hashlib
 import validators
@@ -19,6 +26,10 @@ import toml
 import semver
 from semver import Version
 from typing import Optional, Tuple
+if platform.system() == "Windows":
+    import msvcrt
+else:
+    import fcntl
 
 # SemVer class to compare semantic versions
 # Requires Python semver package
@@ -144,12 +155,12 @@ def sha256_hash_file(filename):
         return None
     
 # Function to download ethdo from Github
-def install_ethdo(url,dockerized=False):
+def install_ethdo(url,dockerized=False,install_dir="."):
     filename = os.path.basename(urlparse(url).path)
     extension = os.path.splitext(filename)[1].lower()
-    tar_file_path = f"./{filename}"
-    extracted_dir = f"./tmp"
-    final_ethdo_path =  "./ethdo" if not dockerized else "/usr/local/bin/ethdo"
+    tar_file_path = os.path.join(install_dir, filename)
+    extracted_dir = os.path.join(install_dir, "tmp")
+    final_ethdo_path =  os.path.join(install_dir, "ethdo") if not dockerized else "/usr/local/bin/ethdo"
 
     # Check if ethdo is already installed
     if os.path.exists(final_ethdo_path):
@@ -224,9 +235,9 @@ def detect_validatorejector_directory(expected_home_directory="/opt/stereum"):
 
     # Warn on multiple matches
     if len(matching_folders) > 1:
-        print(f"Warning: Found multiple validatorejector directories in {directory_path}. Using the first match.")
+        print(f"Warning: Found multiple validatorejector directories in {directory_path}. Using the first match.", file=sys.stderr)
         for folder in matching_folders:
-            print(f"Found folder: {folder}")
+            print(f"Found folder: {folder}", file=sys.stderr)
 
     # Return the first match (or None if no match)
     return matching_folders[0] if matching_folders else None
@@ -274,29 +285,348 @@ def is_whole_number(num, strict=False):
         # num is not numeric or a string
         return False
     
+# Compact record of a validator returned by KAPI (only the fields the signer needs)
+class ValidatorRecord:
+    __slots__ = ("key", "validatorIndex")
+
+    def __init__(self, key, validatorIndex):
+        self.key = key
+        self.validatorIndex = validatorIndex
+
+# Incrementally parse the objects of the top level "data" array from a stream of text chunks
+# Only one array item is decoded at a time, so the full response is never held in memory
+# Example:
+# chunks = ['{"data":[{"key":"0x1","validatorIndex":1},', '{"key":"0x2","validatorIndex":2}]}']
+# print([item["key"] for item in iter_json_data_array(chunks)]) # ['0x1', '0x2']
+def iter_json_data_array(chunks, key="data"):
+    decoder = json.JSONDecoder()
+    pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    chunks = iter(chunks)
+    buffer = ""
+    pos = None
+    eof = False
+
+    # Find the start of the array
+    while pos is None:
+        match = pattern.search(buffer)
+        if match:
+            pos = match.end()
+            break
+        try:
+            # Keep a small tail in case the key is split between chunks
+            buffer = buffer[-(len(key) + 64):] + next(chunks)
+        except StopIteration:
+            raise RuntimeError(f"KAPI responded with invalid format ({key} key missing)")
+
+    # Decode array items one by one
+    while True:
+        # Skip whitespace and separators
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer):
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                yield item
+                buffer = buffer[end:]
+                pos = 0
+                continue
+            except json.JSONDecodeError:
+                # Item not complete yet
+                if eof:
+                    raise RuntimeError(f"KAPI responded with invalid format (could not parse {key} array)")
+        elif eof:
+            raise RuntimeError(f"KAPI responded with invalid format ({key} array not terminated)")
+        try:
+            buffer = buffer[pos:] + next(chunks)
+            pos = 0
+        except StopIteration:
+            eof = True
+
 # Function to get validators that need signed exit messages from KAPI
-def get_validators_that_need_a_signed_exit_message_from_kapi(operator_id, kapi_url, percent=10):
+# The response is stream-parsed and yields compact ValidatorRecord objects, so memory stays flat
+# no matter how many validators the operator has (KAPI does not page this endpoint)
+# Raises RuntimeError with the reason if the request fails, also while iterating the streamed response
+def get_validators_that_need_a_signed_exit_message_from_kapi(operator_id, kapi_url, percent=10, chunk_size=65536):
     if not is_whole_number(operator_id):
         if operator_id:
-            print(f'Invalid operator id "{operator_id}" for KAPI request specified')
-        else:
-            print(f'No operator id for KAPI request specified') 
-        return False
+            raise RuntimeError(f'Invalid operator id "{operator_id}" for KAPI request specified')
+        raise RuntimeError('No operator id for KAPI request specified')
+    percent = percent if is_whole_number(percent) and percent > 0 and percent <= 100 else 10
+    try:
+        result = requests.get(f"{kapi_url}/v1/modules/1/validators/validator-exits-to-prepare/{operator_id}?percent={percent}", stream=True)
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Request to KAPI failed with error: {e}") from e
+    if result.status_code != 200:
+        result.close()
+        raise RuntimeError(f"Request to KAPI failed with status code: {result.status_code}")
+
+    # Generator that yields each validator as soon as it was parsed from the response
+    def records():
+        try:
+            if result.encoding is None:
+                result.encoding = "utf-8"
+            for validator in iter_json_data_array(result.iter_content(chunk_size=chunk_size, decode_unicode=True)):
+                yield ValidatorRecord(validator["key"], validator["validatorIndex"])
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Reading KAPI response failed with error: {e}") from e
+        except KeyError as e:
+            raise RuntimeError(f"KAPI responded with invalid format (validator without {e} key)") from e
+        except (TypeError, UnicodeDecodeError) as e:
+            raise RuntimeError(f"KAPI responded with invalid format ({e})") from e
+        finally:
+            result.close()
+
+    return records()
+
+# Read measured signing throughput of earlier runs from stats file (None if not available)
+def read_signing_stats(stats_file):
+    if not os.path.exists(stats_file):
+        return None
+    try:
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+        if stats.get("validators", 0) > 0 and stats.get("wall_seconds", 0) > 0:
+            return stats
+    except (OSError, ValueError) as e:
+        print(f"Could not read signing stats file '{stats_file}' ({e})")
+    return None
+
+# Add measured signing throughput of a run to the stats file
+# Totals are accumulated over all runs so the average gets more accurate over time
+# Concurrent runs update the file under a lock, so no run loses the update of another
+def update_signing_stats(stats_file, validators, wall_seconds, cpu_seconds):
+    if validators < 1 or wall_seconds <= 0:
+        return None
     try:
-        percent = percent if is_whole_number(percent) and percent > 0 and percent <= 100 else 10
-        result = requests.get(f"{kapi_url}/v1/modules/1/validators/validator-exits-to-prepare/{operator_id}?percent={percent}")
-        if result.status_code == 200:
-            jsonresp = result.json()
-            if "data" in jsonresp:
-                return jsonresp
-            print(f"KAPI responded with invalid format (data key missing)")
+        with hold_lock(f"{stats_file}.lock"):
+            stats = read_signing_stats(stats_file) or {"runs": 0, "validators": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+            stats["runs"] += 1
+            stats["validators"] += validators
+            stats["wall_seconds"] += wall_seconds
+            stats["cpu_seconds"] += cpu_seconds
+            write_file_atomic(stats_file, json.dumps(stats, indent=2))
+    except (OSError, LockTimeoutError) as e:
+        print(f"Could not write signing stats file '{stats_file}' ({e})")
+        return None
+    return stats
+
+# Estimate wall time and core usage to sign given number of validators
+# Uses measured throughput from earlier runs, otherwise falls back to an average of 30 seconds per validator on one core
+def estimate_signing_cost(validators, stats=None, default_seconds_per_validator=30):
+    if stats:
+        seconds_per_validator = stats["wall_seconds"] / stats["validators"]
+        cores = stats["cpu_seconds"] / stats["wall_seconds"] if stats["cpu_seconds"] > 0 else 1.0
+        source = "measured"
+    else:
+        seconds_per_validator = float(default_seconds_per_validator)
+        cores = 1.0
+        source = "default"
+    return {
+        "source": source,   # "measured" if based on earlier runs, otherwise "default"
+        "seconds_per_validator": round(seconds_per_validator, 2),
+        "cores": round(cores, 2),   # Average number of CPU cores busy while signing
+        "wall_seconds": round(seconds_per_validator * validators),
+        "cpu_seconds": round(seconds_per_validator * cores * validators),
+    }
+
+# Get CPU seconds (user + system) consumed by finished child processes, e.g. ethdo
+# Note that this is always 0 on Windows
+def get_children_cpu_seconds():
+    times = os.times()
+    return times.children_user + times.children_system
+
+# Return true if a process with given pid is running on this host
+def is_process_running(pid):
+    if pid <= 0:
+        return False
+    if platform.system() == "Windows":
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
             return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process exists but is owned by another user
+        return True
+    return True
+
+# Owner infos written to claim files
+def get_owner_info():
+    return {"pid": os.getpid(), "host": platform.node(), "time": time.time()}
+
+# Return true if claim file is stale (owner process died or file is older than max_age seconds)
+def is_stale_owner_file(file_path, max_age):
+    try:
+        with open(file_path, 'r') as f:
+            owner = json.load(f)
+    except FileNotFoundError:
+        return True
+    except (OSError, ValueError):
+        # Partially written or unreadable, only consider it stale after max_age
+        try:
+            return time.time() - os.path.getmtime(file_path) > max_age
+        except OSError:
+            return True
+    if time.time() - owner.get("time", 0) > max_age:
+        return True
+    if owner.get("host") == platform.node() and not is_process_running(owner.get("pid", 0)):
+        return True
+    return False
+
+# Raised if a lock could not be acquired within its timeout
+class LockTimeoutError(RuntimeError):
+    pass
+
+# Acquire advisory OS lock on lock_file (flock on Linux/macOS, msvcrt.locking on Windows)
+# The OS releases the lock if the owning process dies, so there are no stale locks to break
+# Returns the open lock file to pass to release_lock, or None if the lock was not acquired within timeout seconds
+def acquire_lock(lock_file, timeout=30):
+    deadline = time.monotonic() + timeout
+    lock = open(lock_file, 'a+')
+    while True:
+        try:
+            if platform.system() == "Windows":
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except OSError:
+            if time.monotonic() > deadline:
+                lock.close()
+                return None
+            time.sleep(0.1)
+
+# Release advisory lock acquired by acquire_lock
+# The lock file itself is kept, removing it would allow two processes to lock different files
+def release_lock(lock):
+    try:
+        if platform.system() == "Windows":
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
         else:
-            print(f"Request to KAPI failed with status code: {result.status_code}")
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock.close()
+
+# Hold advisory lock on lock_file (raises LockTimeoutError if not acquired within timeout seconds)
+@contextlib.contextmanager
+def hold_lock(lock_file, timeout=30):
+    lock = acquire_lock(lock_file, timeout)
+    if lock is None:
+        raise LockTimeoutError(f"Could not acquire lock '{lock_file}' within {timeout} seconds")
+    try:
+        yield
+    finally:
+        release_lock(lock)
+
+# Hold the advisory lock of a claims folder (raises LockTimeoutError if not acquired within timeout seconds)
+def claims_folder_lock(claims_folder, timeout=30):
+    return hold_lock(os.path.join(claims_folder, "exitsigner.lock"), timeout)
+
+# Get folder for lock and claim files of given messages folder
+# This is a sibling of the messages folder so the Validator Ejector never sees these files
+def get_claims_folder(message_folder):
+    return os.path.join(os.path.dirname(os.path.normpath(message_folder)), "exitsigner-claims")
+
+# Claim validator for signing so concurrent exitsigner runs on the same messages folder split the work
+# Returns False if a message already exists or another live run holds the claim
+# Claims of dead processes or older than claim_timeout seconds are reclaimed
+# Raises LockTimeoutError if the claims folder lock could not be acquired
+def claim_validator(claims_folder, message_folder, validator_key, claim_timeout=3600):
+    claim_file = os.path.join(claims_folder, f"{validator_key}.claim")
+    with claims_folder_lock(claims_folder):
+        if os.path.exists(os.path.join(message_folder, f"{validator_key}.json")):
             return False
-    except Exception as e:
-            print(f"Request to KAPI failed with error: {e}")
+        if os.path.exists(claim_file) and not is_stale_owner_file(claim_file, claim_timeout):
             return False
+        with open(claim_file, 'w') as f:
+            json.dump(get_owner_info(), f)
+        return True
+
+# Release claim of validator created by claim_validator
+def release_validator_claim(claims_folder, validator_key):
+    try:
+        os.remove(os.path.join(claims_folder, f"{validator_key}.claim"))
+    except FileNotFoundError:
+        pass
+
+# Default scrypt parameters for encrypted messages (as recommended by EIP-2335)
+KEYSTORE_SCRYPT_PARAMS = {"dklen": 32, "n": 262144, "p": 1, "r": 8}
+
+# Normalize password for EIP-2335 keystores (NFKD and without control codes)
+def normalize_keystore_password(password):
+    password = unicodedata.normalize("NFKD", password)
+    password = "".join(c for c in password if not (ord(c) < 0x20 or 0x7F <= ord(c) <= 0x9F))
+    return password.encode("utf-8")
+
+# Derive the scrypt decryption key of an EIP-2335 keystore (CPU and memory heavy, ~256MB with default params)
+# Returns tuple of (kdf params incl. salt, derived key) so it can be reused for many messages
+def derive_keystore_key(password, salt=None, params=KEYSTORE_SCRYPT_PARAMS):
+    salt = salt if salt is not None else os.urandom(32)
+    derived_key = hashlib.scrypt(
+        normalize_keystore_password(password),
+        salt=salt,
+        n=params["n"],
+        r=params["r"],
+        p=params["p"],
+        dklen=params["dklen"],
+        maxmem=128 * params["r"] * params["n"] * params["p"] + 2**20,
+    )
+    return ({**params, "salt": salt.hex()}, derived_key)
+
+# Encrypt message into an EIP-2335 keystore (the format read by the Validator Ejector for encrypted messages)
+# The derived key (and thus the salt) from derive_keystore_key is reused, each message gets its own random IV
+def encrypt_keystore_message(message, kdf_params, derived_key, iv=None):
+    iv = iv if iv is not None else os.urandom(16)
+    encryptor = Cipher(algorithms.AES(derived_key[:16]), modes.CTR(iv)).encryptor()
+    cipher_message = encryptor.update(message.encode("utf-8")) + encryptor.finalize()
+    checksum = hashlib.sha256(derived_key[16:32] + cipher_message).hexdigest()
+    return {
+        "crypto": {
+            "kdf": {"function": "scrypt", "params": kdf_params, "message": ""},
+            "checksum": {"function": "sha256", "params": {}, "message": checksum},
+            "cipher": {"function": "aes-128-ctr", "params": {"iv": iv.hex()}, "message": cipher_message.hex()},
+        },
+        "description": "",
+        "pubkey": "",
+        "path": "",
+        "uuid": str(uuid.uuid4()),
+        "version": 4,
+    }
+
+# Get current umask of the process (without changing it)
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Write file atomically by writing to a hidden tmp file next to it first and moving it to path afterwards
+# The tmp file is on the same file system as path (so the move is atomic) and does not match '0x*.json'
+# The file gets the same permissions as a regularly created file (0666 minus umask), mkstemp would create it with 0600
+def write_file_atomic(path, content, mode=None):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode if mode is not None else 0o666 & ~get_umask())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 # Get first key from list where value contains "search"
 # Example
@@ -388,6 +718,45 @@ def get_last_line(text):
         # Return None or handle the case where there are no lines
         return None
     
+# Classify ethdo error by the last line of its stderr output
+# Returns "fatal" if no further validator can be signed (e.g. invalid mnemonic), "permanent" if only the
+# affected validator can not be signed (e.g. key not found within max distance) or "transient" otherwise
+# Examples:
+# print(classify_ethdo_error("mnemonic is invalid")) # fatal
+# print(classify_ethdo_error("validator not found within max distance")) # permanent
+# print(classify_ethdo_error("failed to connect to beacon node")) # transient
+# print(classify_ethdo_error("failed to obtain chain info: not found")) # transient
+ETHDO_FATAL_ERRORS = ("mnemonic is invalid", "invalid mnemonic", "offline-preparation.json", "offline preparation", "unknown flag", "unknown command", "command not found")
+ETHDO_PERMANENT_ERRORS = ("within max distance", "validator not found", "validator not known", "unknown validator", "no validator found", "already exited", "validator is not active", "invalid validator")
+def classify_ethdo_error(last_line):
+    error = (last_line or "").lower()
+    if any(pattern in error for pattern in ETHDO_FATAL_ERRORS):
+        return "fatal"
+    if any(pattern in error for pattern in ETHDO_PERMANENT_ERRORS):
+        return "permanent"
+    return "transient"
+
+# Get delay in seconds before retrying after given failed attempt (exponential backoff capped at max_retry_delay)
+# Examples:
+# print(get_retry_delay(1)) # 5
+# print(get_retry_delay(3)) # 20
+# print(get_retry_delay(10)) # 300
+def get_retry_delay(attempt, retry_delay=5, max_retry_delay=300):
+    return min(retry_delay * 2 ** (attempt - 1), max_retry_delay)
+
+# Format seconds as human readable duration
+# Examples:
+# print(format_duration(42)) # 42s
+# print(format_duration(754)) # 12m 34s
+# print(format_duration(7384)) # 2h 03m
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
 # Get input without visibility on CLI
 def get_secure_input(prompt):
     try: